@@ -1,43 +1,95 @@
 """Config file for setting shared paths, imports, etc across the project"""
 
 import os
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
 
 
-out_dir = Path(os.getenv("OUTPUT_DIR"))
-# path to directory containing CORDEX data
-cordex_dir = Path(os.getenv("CORDEX_DIR"))
-# Auxiliary directory is for requested outputs that seem like they might
-#  be a one-time or limited use item
-aux_dir = out_dir.joinpath("auxiliary_content")
-aux_dir.mkdir(exist_ok=True)
+# environment variables holding the base directories for the project
+_env_dirs = {
+    # path to directory for all outputs
+    "out_dir": "OUTPUT_DIR",
+    # path to directory containing CORDEX data
+    "cordex_dir": "CORDEX_DIR",
+}
 
+# paths derived from the base directories, as (parent path name, child name)
+_sub_paths = {
+    # Auxiliary directory is for requested outputs that seem like they might
+    #  be a one-time or limited use item
+    "aux_dir": ("out_dir", "auxiliary_content"),
+    # path to dataset of extreme variables calculated on an annal basis
+    #  for the entire domain of the CORDEX data.
+    "indices_fp": ("out_dir", "annual_indices.nc"),
+    # path to directory for caching the historical day-of-year percentiles used for
+    #  the spell duration indices, so they are only derived once per model.
+    #  Clear it after changing how the percentiles are derived in indices.py
+    "hist_percentile_dir": ("out_dir", "hist_percentiles"),
+    # path to era-based summary extractions of indices done for the main set of point locations
+    # CSVs
+    "idx_era_summary_dir": ("out_dir", "era_extractions"),
+    # Excel file
+    "idx_era_summary_fp": ("out_dir", "indices_era_extractions.xlsx"),
+    # path to decade-based summary extractions of indices done for the main set of point locations
+    # CSVs
+    "idx_decade_summary_dir": ("out_dir", "era_extractions"),
+    # Excel file
+    "idx_decade_summary_fp": ("out_dir", "indices_decadal_extractions.xlsx"),
+    # path to directory that will contain barplots of summaries over decades
+    "era_summary_dir": ("aux_dir", "era_summary_charts"),
+    # path to directory that will contain barplots of summaries over decades
+    "decadal_summary_dir": ("aux_dir", "decadal_summary_charts"),
+}
 
-# path to dataset of extreme variables calculated on an annal basis
-#  for the entire domain of the CORDEX data.
-indices_fp = out_dir.joinpath("annual_indices.nc")
 
-# path to era-based summary extractions of indices done for the main set of point locations
-# CSVs
-idx_era_summary_dir = out_dir.joinpath("era_extractions")
-idx_era_summary_dir.mkdir(exist_ok=True)
-# Excel file
-idx_era_summary_fp = out_dir.joinpath("indices_era_extractions.xlsx")
+@lru_cache(maxsize=None)
+def _path(name):
+    """Resolve one of the paths in _env_dirs or _sub_paths, reading the environment variable it derives from
+    when it is first used rather than when this module is imported.
+    
+    Args:
+        name (str): name of the path, e.g. "out_dir"
+        
+    Returns:
+        pathlib.Path for name
+    """
+    if name in _env_dirs:
+        value = os.getenv(_env_dirs[name])
+        if value is None:
+            raise RuntimeError(f"The {_env_dirs[name]} environment variable needs to be set to use config.{name}")
+        return Path(value)
+    
+    parent, child = _sub_paths[name]
+    return _path(parent).joinpath(child)
 
-# path to decade-based summary extractions of indices done for the main set of point locations
-# CSVs
-idx_decade_summary_dir = out_dir.joinpath("era_extractions")
-idx_decade_summary_dir.mkdir(exist_ok=True)
-# Excel file
-idx_decade_summary_fp = out_dir.joinpath("indices_decadal_extractions.xlsx")
 
-# path to directory that will contain barplots of summaries over decades
-era_summary_dir = aux_dir.joinpath("era_summary_charts")
-era_summary_dir.mkdir(exist_ok=True)
+def __getattr__(name):
+    """Give access to the paths as module attributes, e.g. config.out_dir. These are not module globals,
+    so they are not brought in by "from config import *", and need to be accessed through the module.
+    """
+    if name in _env_dirs or name in _sub_paths:
+        return _path(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def ensure_dirs():
+    """Create the output directories defined above if they don't exist yet. Called by the notebooks that
+    write outputs, rather than on every import of this module.
+    """
+    # aux_dir first, as it contains some of the others
+    for name in [
+        "aux_dir",
+        "hist_percentile_dir",
+        "idx_era_summary_dir",
+        "idx_decade_summary_dir",
+        "era_summary_dir",
+        "decadal_summary_dir",
+    ]:
+        _path(name).mkdir(exist_ok=True)
 
-# path to directory that will contain barplots of summaries over decades
-decadal_summary_dir = aux_dir.joinpath("decadal_summary_charts")
-decadal_summary_dir.mkdir(exist_ok=True)
 
 # dict of WGS84 coords for each of the locations
 locations = {
@@ -94,3 +146,94 @@ idx_varname_lu = {
 
 # template filename
 temp_fn = "ARC44_{}_{}_{}_ERA5bc.nc"
+
+# dask chunking for reading CORDEX data. The full time series is kept in each chunk
+#  because all indices reduce along time, and the numba kernels in indices.py need the
+#  whole time axis in a single block. Spatial blocks are sized by dask.
+cordex_chunks = {"time": -1, "lat": "auto", "lon": "auto"}
+
+
+@lru_cache(maxsize=None)
+def cordex_fp(scenario, varname, model):
+    """Get the path to a CORDEX file
+    
+    Args:
+        scenario (str): scenario name
+        varname (str): model variable name
+        model (str): model name
+        
+    Returns:
+        pathlib.Path to the file in cordex_dir
+    """
+    return _path("cordex_dir").joinpath(scenario, varname, temp_fn.format(scenario, varname, model))
+
+
+def open_cordex(scenario, varname, model):
+    """Open a CORDEX file as a dask-backed xarray.Dataset, chunked according to cordex_chunks
+    
+    Args:
+        scenario (str): scenario name
+        varname (str): model variable name
+        model (str): model name
+        
+    Returns:
+        xarray.Dataset for the file
+    """
+    return xr.open_dataset(cordex_fp(scenario, varname, model), chunks=cordex_chunks)
+
+
+def clip_to_locations(da, pad=1):
+    """Subset a DataArray to the bounding box of the point locations, for processing only the area
+    needed for the location extractions instead of the full domain.
+    
+    Args:
+        da (xarray.DataArray): DataArray with lat and lon dimensions
+        pad (float): padding in degrees added to all sides of the bounding box
+        
+    Returns:
+        DataArray subset to the bounding box of the locations
+    """
+    lats, lons = np.array(list(locations.values())).T
+    lat_sl = slice(lats.min() - pad, lats.max() + pad)
+    lon_sl = slice(lons.min() - pad, lons.max() + pad)
+    # label-based slices need to follow the order of the coordinates
+    if da["lat"].values[0] > da["lat"].values[-1]:
+        lat_sl = slice(lat_sl.stop, lat_sl.start)
+    if da["lon"].values[0] > da["lon"].values[-1]:
+        lon_sl = slice(lon_sl.stop, lon_sl.start)
+    
+    return da.sel(lat=lat_sl, lon=lon_sl)
+
+
+def summary_csv_fp(kind, location):
+    """Get the path to the CSV of era or decade summaries of the indices for a location, as written by extract_indices.ipynb.
+    These CSVs are the canonical store of the summaries, the Excel files are rendered from them with summaries_to_xlsx.
+    
+    Args:
+        kind (str): type of summary, either "era" or "decade"
+        location (str): name of the location, a key of locations
+        
+    Returns:
+        pathlib.Path to the CSV
+    """
+    summary_dir = {"era": "idx_era_summary_dir", "decade": "idx_decade_summary_dir"}[kind]
+    return _path(summary_dir).joinpath(f"{kind}_summaries_{location}.csv")
+
+
+def summaries_to_xlsx(kind):
+    """Render the summary CSVs of one type to an Excel file for sharing, with one worksheet per location.
+    
+    Args:
+        kind (str): type of summary, either "era" or "decade"
+        
+    Returns:
+        pathlib.Path to the Excel file written
+    """
+    xlsx_fp = _path({"era": "idx_era_summary_fp", "decade": "idx_decade_summary_fp"}[kind])
+    with pd.ExcelWriter(xlsx_fp, engine="openpyxl") as writer:
+        for location in locations:
+            df = pd.read_csv(summary_csv_fp(kind, location))
+            df.to_excel(writer, sheet_name=location, index=False)
+    
+    return xlsx_fp
+
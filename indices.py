@@ -1,26 +1,592 @@
 """This script includes functions that define the various extreme variables we will by deriving"""
 
+import hashlib
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
 import numpy as np
-import xclim.indices as xci
-from xclim.core.calendar import percentile_doy
-from xclim.core.units import convert_units_to, to_agg_units
-from xclim.indices.generic import threshold_count
+import xarray as xr
+from numba import njit, prange
+from xclim.core.calendar import adjust_doy_calendar, build_climatology_bounds
+from xclim.core.units import convert_units_to
 
 
-def take_sorted(arr, axis, idx):
-    """Helper function for the 'hot day' and 'cold day' indices to slice a numpy array after sorting it. Done in favor of fixed, []-based indexing.
+# index functions by index name, and metadata about them, populated by the register decorator
+INDEX_FUNCS = {}
+INDEX_META = {}
+
+
+def register(name, needs_hist=False):
+    """Decorator for adding an index function to INDEX_FUNCS under the given index name, along with its metadata in INDEX_META
+    
+    Args:
+        name (str): name of the index, as used in config.idx_varname_lu
+        needs_hist (bool): whether the index function needs historical data for the same variable and model,
+            passed as the hist_da keyword argument
+        
+    Returns:
+        decorator that registers the function and returns it unchanged
+    """
+    def deco(func):
+        INDEX_FUNCS[name] = func
+        INDEX_META[name] = {"needs_hist": needs_hist}
+        return func
+    
+    return deco
+
+
+def year_bounds(index):
+    """Helper function to find the positions where each calendar year starts and ends along a time index.
+    
+    Args:
+        index (pandas.Index): sorted time index, e.g. from DataArray.get_index("time"), either a DatetimeIndex or CFTimeIndex
+        
+    Returns:
+        tuple of (starts, ends) integer arrays, such that year i spans time[starts[i]:ends[i]]
+    """
+    years = np.asarray(index.year)
+    starts = np.flatnonzero(np.diff(years, prepend=years[0] - 1))
+    ends = np.append(starts[1:], years.size)
+    
+    return starts, ends
+
+
+@lru_cache(maxsize=None)
+def units_factor(units, target):
+    """Helper function to get the factor that converts values in some units to other units by multiplication.
+    Results are cached, so each conversion is only looked up once per process rather than for every file.
+    
+    Args:
+        units (str): units of the data, e.g. "kg m-2 s-1"
+        target (str): units to convert to, e.g. "mm/day"
+        
+    Returns:
+        conversion factor as a float
+    """
+    return float(convert_units_to(f"1 {units}", target, "hydro"))
+
+
+@lru_cache(maxsize=None)
+def threshold_value(thresh, units):
+    """Helper function to convert a threshold string to a value in the units of the data it is compared with.
+    Results are cached, so each threshold is only parsed once per process rather than for every file.
+    
+    Args:
+        thresh (str): threshold with units, e.g. "10 mm/day"
+        units (str): units of the data, e.g. "kg m-2 s-1"
+        
+    Returns:
+        threshold value as a float
+    """
+    return float(convert_units_to(thresh, units, "hydro"))
+
+
+@njit(parallel=True, cache=True)
+def _annual_order_stat(vals, starts, ends, k, scale, offset, out):
+    """Numba kernel for annual_order_stat, parallelized over grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        k (int): position in the sorted values of a year to take, negative values count from the end
+        scale (float): factor to multiply results by, e.g. for unit conversion
+        offset (float): value to add to results after scaling
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    for c in prange(vals.shape[1]):
+        for y in range(starts.size):
+            year = vals[starts[y]:ends[y], c]
+            kk = k % year.size
+            out[y, c] = np.partition(year, kk)[kk] * scale + offset
+
+
+@njit(parallel=True, cache=True)
+def _annual_extreme(vals, starts, ends, largest, scale, offset, out):
+    """Numba kernel for annual_order_stat with k=0 or k=-1, taking the minimum or maximum of each year in a
+    single pass instead of a partition. nans are handled as np.partition does, which sorts them to the end:
+    the minimum is the smallest non-nan value, and the maximum is nan if there are any nans.
+    Parallelized over grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        largest (bool): take the maximum if True, the minimum otherwise
+        scale (float): factor to multiply results by, e.g. for unit conversion
+        offset (float): value to add to results after scaling
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    for c in prange(vals.shape[1]):
+        for y in range(starts.size):
+            if largest:
+                stat = np.max(vals[starts[y]:ends[y], c])
+            else:
+                stat = np.nanmin(vals[starts[y]:ends[y], c])
+            out[y, c] = stat * scale + offset
+
+
+@njit(parallel=True, cache=True)
+def _annual_top_mean(vals, starts, ends, n, scale, offset, out):
+    """Numba kernel for the mean of the n largest values in each year, streaming through the days of each year
+    with a min-heap of the n largest values seen so far for each cell. Years with any nan values, or with fewer
+    than n values, give nan.
+    Parallelized over years, with the inner loop running over contiguous grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        n (int): number of largest values to average
+        scale (float): factor to multiply results by, e.g. for unit conversion
+        offset (float): value to add to results after scaling
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    ncells = vals.shape[1]
+    for y in prange(starts.size):
+        # heap[:, c] is a binary min-heap of the largest values of cell c, with the smallest of them at heap[0, c]
+        heap = np.full((n, ncells), -np.inf, dtype=vals.dtype)
+        has_nan = np.zeros(ncells, dtype=np.bool_)
+        # number of non-nan values seen for each cell, to catch years shorter than n days
+        count = np.zeros(ncells, dtype=np.int64)
+        for t in range(starts[y], ends[y]):
+            for c in range(ncells):
+                x = vals[t, c]
+                if np.isnan(x):
+                    has_nan[c] = True
+                    continue
+                count[c] += 1
+                if x > heap[0, c]:
+                    # replace the smallest value and sift it down to restore the heap
+                    i = 0
+                    while True:
+                        child = 2 * i + 1
+                        if child >= n:
+                            break
+                        if child + 1 < n and heap[child + 1, c] < heap[child, c]:
+                            child += 1
+                        if heap[child, c] >= x:
+                            break
+                        heap[i, c] = heap[child, c]
+                        i = child
+                    heap[i, c] = x
+        for c in range(ncells):
+            if has_nan[c] or count[c] < n:
+                out[y, c] = np.nan
+            else:
+                out[y, c] = heap[:, c].sum() / n * scale + offset
+
+
+@njit(parallel=True, cache=True)
+def _annual_max_sum(vals, starts, ends, window, scale, out):
+    """Numba kernel for the maximum sum of values over window consecutive days in each year. Windows are labeled
+    by their last day, so they can start in the previous year, and windows containing nan values are skipped.
+    Parallelized over years, with the inner loop running over contiguous grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        window (int): number of consecutive days to sum over
+        scale (float): factor to multiply each value by before summing, e.g. for unit conversion
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    ncells = vals.shape[1]
+    for y in prange(starts.size):
+        # sums are accumulated in double precision, and cast to the data type of out when they are stored
+        best = np.full(ncells, -np.inf)
+        # the first days of the series do not have a full window before them
+        for t in range(max(starts[y], window - 1), ends[y]):
+            for c in range(ncells):
+                total = 0.0
+                for w in range(t - window + 1, t + 1):
+                    total += vals[w, c] * scale
+                if total > best[c]:
+                    best[c] = total
+        for c in range(ncells):
+            out[y, c] = best[c] if best[c] > -np.inf else np.nan
+
+
+@njit(parallel=True, cache=True)
+def _annual_count(vals, starts, ends, thresh, above, out):
+    """Numba kernel for the number of days above (or below) a threshold in each year.
+    Parallelized over years, with the inner loop running over contiguous grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        thresh (float): threshold value
+        above (bool): count days with values above thresh if True, below if False
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    ncells = vals.shape[1]
+    for y in prange(starts.size):
+        count = np.zeros(ncells, dtype=np.int64)
+        for t in range(starts[y], ends[y]):
+            for c in range(ncells):
+                count[c] += (vals[t, c] > thresh) if above else (vals[t, c] < thresh)
+        out[y] = count
+
+
+@njit(parallel=True, cache=True)
+def _annual_longest_run(vals, starts, ends, thresh, above, out):
+    """Numba kernel for the length of the longest run of days above (or below) a threshold in each year.
+    Parallelized over years, with the inner loop running over contiguous grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        thresh (float): threshold value
+        above (bool): count days with values above thresh if True, below if False
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    ncells = vals.shape[1]
+    for y in prange(starts.size):
+        run = np.zeros(ncells, dtype=np.int64)
+        longest = np.zeros(ncells, dtype=np.int64)
+        for t in range(starts[y], ends[y]):
+            for c in range(ncells):
+                if (vals[t, c] > thresh) if above else (vals[t, c] < thresh):
+                    run[c] += 1
+                    longest[c] = max(longest[c], run[c])
+                else:
+                    run[c] = 0
+        out[y] = longest
+
+
+@njit(parallel=True, cache=True)
+def _annual_spell_days(vals, starts, ends, thresh, doy_idx, above, window, out):
+    """Numba kernel for the number of days in each year that are part of runs of at least window days
+    above (or below) a day-of-year threshold. Runs are cut at year boundaries.
+    Parallelized over years, with the inner loop running over contiguous grid cells.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (time, cells)
+        starts (numpy.ndarray): start positions of each year along time
+        ends (numpy.ndarray): end positions of each year along time
+        thresh (numpy.ndarray): 2D array of threshold values of shape (dayofyear, cells)
+        doy_idx (numpy.ndarray): position in thresh for each time step, -1 if the day of year has no threshold
+        above (bool): count days with values above thresh if True, below if False
+        window (int): minimum number of consecutive days for a spell
+        out (numpy.ndarray): 2D array of shape (years, cells) to write results to
+    """
+    ncells = vals.shape[1]
+    for y in prange(starts.size):
+        run = np.zeros(ncells, dtype=np.int64)
+        total = np.zeros(ncells, dtype=np.int64)
+        for t in range(starts[y], ends[y]):
+            d = doy_idx[t]
+            for c in range(ncells):
+                if d >= 0 and ((vals[t, c] > thresh[d, c]) if above else (vals[t, c] < thresh[d, c])):
+                    run[c] += 1
+                else:
+                    if run[c] >= window:
+                        total[c] += run[c]
+                    run[c] = 0
+        for c in range(ncells):
+            if run[c] >= window:
+                total[c] += run[c]
+        out[y] = total
+
+
+@njit(cache=True)
+def _order_stat_pair(pool, n, k, buf):
+    """Numba helper to get the order statistics at positions k and k + 1 of the first n values of pool, by keeping
+    a sorted buffer of the m values closest to the nearer end of the sorted values in a single pass, instead of partitioning.
+    This is faster than np.partition for the extreme percentiles used here, where m is small.
+    
+    Args:
+        pool (numpy.ndarray): 1D array of values, without nans
+        n (int): number of values in pool to use
+        k (int): position of the first order statistic, between 0 and n - 2
+        buf (numpy.ndarray): 1D work array with at least min(n - k, k + 2) elements
+        
+    Returns:
+        tuple of the values at positions k and k + 1 of the sorted values
+    """
+    # keep the m largest values of sign * pool, so that small k look for the largest values of -pool
+    if n - k <= k + 2:
+        m, sign = n - k, 1
+    else:
+        m, sign = k + 2, -1
+    
+    count = 0
+    for i in range(n):
+        x = sign * pool[i]
+        if count < m:
+            j = count
+            count += 1
+        elif x > buf[0]:
+            # drop the smallest value kept, and shift smaller values down until x fits
+            j = 0
+            while j + 1 < m and buf[j + 1] < x:
+                buf[j] = buf[j + 1]
+                j += 1
+            buf[j] = x
+            continue
+        else:
+            continue
+        # still filling the buffer, insertion sort step
+        while j > 0 and buf[j - 1] > x:
+            buf[j] = buf[j - 1]
+            j -= 1
+        buf[j] = x
+    
+    if sign == 1:
+        return buf[0], buf[1]
+    
+    return -buf[1], -buf[0]
+
+
+@njit(parallel=True, cache=True)
+def _doy_percentile(vals, order, offsets, window, q, alpha, beta, out):
+    """Numba kernel for doy_percentile, parallelized over grid cells. Each percentile is found by
+    selecting the two order statistics it falls between in the pooled values of a day of year, instead of sorting them.
+    
+    Args:
+        vals (numpy.ndarray): 2D array of shape (cells, time)
+        order (numpy.ndarray): time positions grouped by day of year
+        offsets (numpy.ndarray): day of year d spans order[offsets[d]:offsets[d + 1]]
+        window (int): number of days of the window centered on each time position to pool values from
+        q (float): quantile to derive, between 0 and 1
+        alpha (float): plotting position parameter
+        beta (float): plotting position parameter
+        out (numpy.ndarray): 2D array of shape (cells, dayofyear) to write results to
+    """
+    ncells, ntime = vals.shape
+    half = window // 2
+    pool_size = window * (offsets[1:] - offsets[:-1]).max()
+    for c in prange(ncells):
+        pool = np.empty(pool_size, dtype=vals.dtype)
+        buf = np.empty(pool_size, dtype=vals.dtype)
+        for d in range(offsets.size - 1):
+            # gather the valid values in the windows around all time steps of this day of year
+            n = 0
+            for i in range(offsets[d], offsets[d + 1]):
+                for t in range(max(order[i] - half, 0), min(order[i] - half + window, ntime)):
+                    if not np.isnan(vals[c, t]):
+                        pool[n] = vals[c, t]
+                        n += 1
+            
+            if n == 0:
+                out[c, d] = np.nan
+                continue
+            if n == 1:
+                out[c, d] = pool[0]
+                continue
+            
+            # same interpolation between order statistics as xclim.core.utils.nan_calc_percentiles
+            v = n * q + (alpha + q * (1 - alpha - beta)) - 1
+            if v >= n - 1:
+                out[c, d] = pool[:n].max()
+            elif v < 0:
+                out[c, d] = pool[:n].min()
+            else:
+                k = int(np.floor(v))
+                if min(n - k, k + 2) <= 32:
+                    left, right = _order_stat_pair(pool, n, k, buf)
+                else:
+                    # percentiles far from the ends, a full selection is faster than the sorted buffer
+                    part = np.partition(pool[:n], k)
+                    left, right = part[k], part[k + 1:n].min()
+                diff = right - left
+                gamma = v - k
+                if gamma >= 0.5:
+                    out[c, d] = right - diff * (1 - gamma)
+                else:
+                    out[c, d] = left + diff * gamma
+
+
+def rechunk_time(da):
+    """Helper function to rechunk a dask-backed DataArray to a single chunk along time, if it isn't already, since all
+    indices reduce along time and the numba kernels need the whole time axis in a single block. Spatial chunk sizes are
+    left to dask, to keep blocks to a reasonable size.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        
+    Returns:
+        DataArray with a single chunk along time, or da itself if it already has one or is not dask-backed
+    """
+    if da.chunks is not None and len(da.chunks[da.get_axis_num("time")]) > 1:
+        da = da.chunk({"time": -1, "lat": "auto", "lon": "auto"})
+    
+    return da
+
+
+def apply_annual(kernel, da, *args, doy_thresh=None, dtype=None):
+    """Apply one of the annual numba kernels to a DataArray, in a single call over the whole time series.
+    Dask-backed DataArrays are processed block-wise, and need to have a single chunk along time (see rechunk_time).
+    
+    Args:
+        kernel (callable): numba kernel taking a (time, cells) array, year start and end positions, any arrays of
+            shape (dayofyear, cells) from doy_thresh, *args, and a (years, cells) output array, in that order
+        da (xarray.DataArray): daily values with a time dimension
+        *args: additional arguments for kernel
+        doy_thresh (xarray.DataArray): day-of-year thresholds with dimensions dayofyear, lat, lon, for kernels that need them
+        dtype (numpy.dtype): data type of the result, defaults to the data type of da
+        
+    Returns:
+        DataArray of annual values, with time coordinate values at the start of each year
+    """
+    starts, ends = year_bounds(da.get_index("time"))
+    dtype = da.dtype if dtype is None else np.dtype(dtype)
+    
+    def func(arr, *thresh):
+        # apply_ufunc puts core dimensions last, move them back to get (time or dayofyear, cells) views of the data
+        vals = np.moveaxis(arr, -1, 0).reshape(arr.shape[-1], -1)
+        thresh = [np.moveaxis(a, -1, 0).reshape(a.shape[-1], -1) for a in thresh]
+        out = np.empty((starts.size, vals.shape[1]), dtype=dtype)
+        kernel(vals, starts, ends, *thresh, *args, out)
+        return np.moveaxis(out.reshape((starts.size,) + arr.shape[:-1]), 0, -1)
+    
+    inputs = [da]
+    input_core_dims = [["time"]]
+    if doy_thresh is not None:
+        # only the data values are needed, drop any coordinates that would be carried over to the result
+        doy_thresh = doy_thresh.reset_coords(drop=True)
+        if doy_thresh.chunks is not None:
+            # like time for da, the kernels need all days of the year in a single block
+            doy_thresh = doy_thresh.chunk({"dayofyear": -1})
+        inputs.append(doy_thresh)
+        input_core_dims.append(["dayofyear"])
+    
+    out = xr.apply_ufunc(
+        func,
+        *inputs,
+        input_core_dims=input_core_dims,
+        output_core_dims=[["time"]],
+        exclude_dims={"time"},
+        dask="parallelized",
+        output_dtypes=[dtype],
+        dask_gufunc_kwargs={"output_sizes": {"time": starts.size}},
+    )
+    
+    return out.assign_coords(time=da["time"].values[starts])
+
+
+def annual_order_stat(da, k, scale=1, offset=0):
+    """Derive an order statistic for each year of a DataArray in a single pass, i.e. the value at position k
+    of the sorted values for each year. Used for the 'hot day' and 'cold day' indices.
+    
+    k=0 and k=-1 (the minimum and maximum) are dispatched to a kernel taking a single pass over each year instead of a partition.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        k (int): position in the sorted values of each year to take, negative values count from the end
+        scale (float): factor to multiply results by
+        offset (float): value to add to results after scaling. scale and offset are applied in the kernel,
+            in the data type of da, so that hardcoded unit conversions do not need another pass over the result
+        
+    Returns:
+        DataArray of annual values, with time coordinate values at the start of each year
+    """
+    dtype = da.dtype.type
+    if k in (0, -1):
+        return apply_annual(_annual_extreme, da, k == -1, dtype(scale), dtype(offset))
+    
+    return apply_annual(_annual_order_stat, da, k, dtype(scale), dtype(offset))
+
+
+def annual_top_mean(da, n, scale=1, offset=0):
+    """Derive the mean of the n largest values for each year of a DataArray in a single pass, without
+    sorting or partitioning. Used for the 'heavy snow days' index.
     
     Args:
-        arr (numpy.ndarray): array
-        axis (int): axis to sort and slice according to
-        idx (int): index value to slice arr at across all other axes
+        da (xarray.DataArray): daily values with a time dimension
+        n (int): number of largest values to average
+        scale (float): factor to multiply results by
+        offset (float): value to add to results after scaling, see annual_order_stat
         
     Returns:
-        array of values at position idx of arr sorted along axis
+        DataArray of annual values, with time coordinate values at the start of each year
     """
-    return np.take(np.sort(arr, axis), idx, axis)
+    dtype = da.dtype.type
+    return apply_annual(_annual_top_mean, da, n, dtype(scale), dtype(offset))
 
 
+def annual_max_sum(da, window, units):
+    """Derive the maximum sum of values over window consecutive days for each year of a DataArray.
+    Used for the max 1-day and 5-day precip indices.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        window (int): number of consecutive days to sum over
+        units (str): daily rate units to convert the values to before summing, e.g. "mm/day"
+        
+    Returns:
+        DataArray of annual values, with time coordinate values at the start of each year
+    """
+    scale = units_factor(da.attrs["units"], units)
+    return apply_annual(_annual_max_sum, da, window, scale, dtype=da.dtype)
+
+
+def annual_count(da, thresh, above):
+    """Derive the number of days above (or below) a threshold for each year of a DataArray.
+    Used for the threshold count indices, e.g. summer days or heavy precip days.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        thresh (str): threshold with units, e.g. "25 degC"
+        above (bool): count days with values above thresh if True, below if False
+        
+    Returns:
+        DataArray of annual counts of days, with time coordinate values at the start of each year
+    """
+    # compare in the data type of da, so float32 data are not compared against a float64 threshold
+    thresh = da.dtype.type(threshold_value(thresh, da.attrs["units"]))
+    out = apply_annual(_annual_count, da, thresh, above, dtype=np.int64)
+    out.attrs["units"] = "d"
+    
+    return out
+
+
+def annual_longest_run(da, thresh, above):
+    """Derive the length of the longest run of days above (or below) a threshold for each year of a DataArray.
+    Used for the consecutive wet / dry days indices.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        thresh (str): threshold with units, e.g. "1 mm/day"
+        above (bool): count days with values above thresh if True, below if False
+        
+    Returns:
+        DataArray of annual counts of days, with time coordinate values at the start of each year
+    """
+    # compare in the data type of da, so float32 data are not compared against a float64 threshold
+    thresh = da.dtype.type(threshold_value(thresh, da.attrs["units"]))
+    out = apply_annual(_annual_longest_run, da, thresh, above, dtype=np.int64)
+    out.attrs["units"] = "d"
+    
+    return out
+
+
+def annual_spell_days(da, doy_thresh, above, window):
+    """Derive the number of days in each year of a DataArray that are part of spells of at least window
+    consecutive days above (or below) a day-of-year threshold. Used for the spell duration indices.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        doy_thresh (xarray.DataArray): day-of-year thresholds, such as from doy_percentile
+        above (bool): count days with values above doy_thresh if True, below if False
+        window (int): minimum number of consecutive days for a spell
+        
+    Returns:
+        DataArray of annual counts of days, with time coordinate values at the start of each year
+    """
+    doy_thresh = adjust_doy_calendar(convert_units_to(doy_thresh, da), da)
+    # position of each time step in the thresholds, -1 for days of year without a threshold value
+    doy_idx = doy_thresh.indexes["dayofyear"].get_indexer(np.asarray(da.get_index("time").dayofyear))
+    out = apply_annual(_annual_spell_days, da, doy_idx, above, window, doy_thresh=doy_thresh, dtype=np.int64)
+    out.attrs["units"] = "d"
+    
+    return out
+
+
+@register("hd")
 def hd(tasmax):
     """'Hot Day' - the 6th hottest day of the year
     
@@ -30,19 +596,15 @@ def hd(tasmax):
     Returns:
         Hot Day values for each year
     """
-    def func(tasmax):
-        # np.sort defaults to ascending.. 
-        #   hd is simply "6th hottest" day
-        return tasmax.reduce(take_sorted, dim="time", idx=-6)
-    
     # hardcoded unit conversion
-    out = tasmax.resample(time="1Y").map(func) - 273.15
+    out = annual_order_stat(tasmax, -6, offset=-273.15)
     out.attrs["units"] = "C"
     out.attrs["comment"] = "'hot day': 6th hottest day of the year"
     
     return out
     
 
+@register("cd")
 def cd(tasmin):
     """'Cold Day' - the 6th coldest day of the year
     
@@ -52,20 +614,15 @@ def cd(tasmin):
     Returns:
         Cold Day values for each year
     """
-    def func(tasmin):
-        # time_ax = np.where(np.array(tasmin.dims) == "time")[0][0]
-        # np.sort defaults to ascending.. 
-        #   cd is simply "6th coldest" day
-        return tasmin.reduce(take_sorted, dim="time", idx=5)
-    
     # hardcoded unit conversion
-    out = tasmin.resample(time="1Y").map(func) - 273.15
+    out = annual_order_stat(tasmin, 5, offset=-273.15)
     out.attrs["units"] = "C"
     out.attrs["comment"] = "'cold day': 6th coldest day of the year"
     
     return out
 
 
+@register("hsd")
 def hsd(prsn):
     """'Heavy snow days' - the mean snowfall of the 5 snowiest days in a year
     
@@ -75,19 +632,14 @@ def hsd(prsn):
     Returns:
         The mean snowfall for the 5 snowiest days in a year
     """
-    def func(prsn):
-        def take_sorted_mean(arr, axis, idx):
-            """Wrapper for take_sorted function to give the mean of the taken values"""
-            return take_sorted(arr, axis, idx).mean(axis=axis)
-        
-        return prsn.reduce(take_sorted_mean, dim="time", idx=np.arange(-5, 0))
-    
-    out = prsn.resample(time="1Y").map(func) * 8640
+    # hardcoded unit conversion
+    out = annual_top_mean(prsn, 5, scale=8640)
     out.attrs["units"] = "cm"
 
     return out
     
 
+@register("rx1day")
 def rx1day(pr):
     """'Max 1-day precip' - the max daily precip value recorded for a year.
     
@@ -97,12 +649,14 @@ def rx1day(pr):
     Returns:
         Max 1-day precip for each year
     """
-    out = xci.max_n_day_precipitation_amount(pr, freq="YS")
+    # sums of daily amounts in mm
+    out = annual_max_sum(pr, 1, "mm/day")
     out.attrs["units"] = "mm"
     
     return out
 
 
+@register("rx5day")
 def rx5day(pr):
     """'Max 5-day precip' - the max 5-day precip value recorded for a year.
     
@@ -112,12 +666,14 @@ def rx5day(pr):
     Returns:
         Max 5-day precip for each year
     """
-    out = xci.max_n_day_precipitation_amount(pr, 5, freq="YS")
+    # sums of daily amounts in mm
+    out = annual_max_sum(pr, 5, "mm/day")
     out.attrs["units"] = "mm"
     
     return out
 
 
+@register("su")
 def su(tasmax):
     """'Summer days' - the number of days with tasmax above 25 C
     
@@ -127,9 +683,10 @@ def su(tasmax):
     Returns:
         Number of summer days for each year
     """
-    return xci.tx_days_above(tasmax, "25 degC", freq="YS")
+    return annual_count(tasmax, "25 degC", above=True)
 
 
+@register("dw")
 def dw(tasmin):
     """'Deep winter days' - the number of days with tasmin below -30 C
     
@@ -139,37 +696,204 @@ def dw(tasmin):
     Returns:
         Number of deep winter days for each year
     """
-    return xci.tn_days_below(tasmin, thresh="-30 degC", freq="YS")
+    return annual_count(tasmin, "-30 degC", above=False)
+
+
+def doy_percentile(da, per, window=5, alpha=1 / 3, beta=1 / 3):
+    """Derive a percentile for each day of the year from the values in a window centered on that day in all years.
+    Drop-in replacement for xclim.core.calendar.percentile_doy with a single percentile, using the same defaults
+    and interpolation, but selecting the order statistics needed instead of sorting each pool of values.
+    Dask-backed DataArrays are processed block-wise, after rechunking to a single chunk along time if needed.
+    
+    Args:
+        da (xarray.DataArray): daily values with a time dimension
+        per (float): percentile to derive, between 0 and 100
+        window (int): number of days of the (odd-sized) window centered on each day to pool values from
+        alpha (float): plotting position parameter
+        beta (float): plotting position parameter
+        
+    Returns:
+        DataArray of percentile values with a dayofyear dimension. For calendars with 366 days,
+        percentiles of days of year 1-365 are interpolated to the 1-366 range, as in percentile_doy.
+    """
+    da = rechunk_time(da)
+    doys = np.asarray(da.get_index("time").dayofyear)
+    # day 366 only occurs in leap years, so its values are only used as part of the windows of other days
+    out_doys = np.unique(doys[doys < 366])
+    doy_idx = np.searchsorted(out_doys, doys)
+    doy_idx[doys == 366] = -1
+    order = np.argsort(doy_idx, kind="stable")
+    offsets = np.searchsorted(doy_idx[order], np.arange(out_doys.size + 1))
+    order = order[offsets[0]:]
+    offsets -= offsets[0]
+    
+    def func(arr):
+        vals = arr.reshape(-1, arr.shape[-1])
+        out = np.empty((vals.shape[0], out_doys.size), dtype=np.float64)
+        _doy_percentile(vals, order, offsets, window, per / 100, alpha, beta, out)
+        return out.reshape(arr.shape[:-1] + (out_doys.size,))
+    
+    out = xr.apply_ufunc(
+        func,
+        da,
+        input_core_dims=[["time"]],
+        output_core_dims=[["dayofyear"]],
+        dask="parallelized",
+        output_dtypes=[np.float64],
+        dask_gufunc_kwargs={"output_sizes": {"dayofyear": out_doys.size}},
+    ).assign_coords(dayofyear=out_doys)
+    
+    if doys.max() == 366:
+        out = adjust_doy_calendar(out, da)
+    
+    out = out.assign_coords(percentiles=per).rename("per")
+    out.attrs.update(da.attrs)
+    out.attrs["climatology_bounds"] = build_climatology_bounds(da)
+    out.attrs["window"] = window
+    out.attrs["alpha"] = alpha
+    out.attrs["beta"] = beta
+    
+    return out
+
+
+# percentile climatologies most recently derived or read by this process, keyed by source file and its size and
+# modification time, variable, time extent, percentile, percentile parameters, and grid. Only the last few are kept,
+# as each worker process holds its own copy, and the files in cache_dir already cover reuse beyond that
+_hist_per_cache = OrderedDict()
+_HIST_PER_CACHE_SIZE = 8
+
+
+def grid_id(da):
+    """Helper function to get a short identifier for the lat / lon grid of a DataArray, so that derived data
+    for spatial subsets of a file can be told apart from data for the full grid.
+    
+    Args:
+        da (xarray.DataArray): DataArray with lat and lon coordinates
+        
+    Returns:
+        8 character hex digest of the lat and lon coordinate values
+    """
+    coords = np.concatenate([da["lat"].values, da["lon"].values]).astype(np.float64)
+    return hashlib.md5(coords.tobytes()).hexdigest()[:8]
+
+
+def hist_percentile(hist_da, per, cache_dir=None, window=5, alpha=1 / 3, beta=1 / 3):
+    """Get the day-of-year percentile climatology of historical data used by the spell duration indices, deriving it only once per historical file, time range and grid.
+    
+    The most recently used percentiles are kept in memory. If cache_dir is supplied, they are also
+    written there as netCDF, and read back on subsequent calls (e.g. from other processes or later runs) instead of being derived again.
+    Cached files are tied to the size and modification time of the historical file, to the time extent of hist_da and to
+    the percentile parameters, so a regenerated historical file or a subset of it in time is picked up. Changes to how doy_percentile derives the percentiles are not,
+    and cache_dir needs to be cleared after any such change.
+    
+    Args:
+        hist_da (xarray.DataArray): historical daily temperature values
+        per (int): percentile to derive
+        cache_dir (path-like): directory for saving derived percentile climatologies
+        window (int): window size, see doy_percentile
+        alpha (float): plotting position parameter, see doy_percentile
+        beta (float): plotting position parameter, see doy_percentile
+        
+    Returns:
+        DataArray of percentile values for each day of the year
+    """
+    source = hist_da.encoding.get("source")
+    if source is None:
+        # not read from a file, so there is no reliable way to tell if this data has been seen before
+        return doy_percentile(hist_da, per, window, alpha, beta)
+    
+    stat = os.stat(source)
+    time = hist_da.get_index("time")
+    key = (
+        source, stat.st_size, stat.st_mtime_ns, hist_da.name, str(time[0]), str(time[-1]), time.size,
+        per, window, alpha, beta, grid_id(hist_da),
+    )
+    if key in _hist_per_cache:
+        _hist_per_cache.move_to_end(key)
+    else:
+        cache_fp = None
+        if cache_dir is not None:
+            # the grid and a digest of everything else the percentiles depend on identify the cached file
+            digest = hashlib.md5(repr(key[1:-1]).encode()).hexdigest()[:8]
+            cache_fp = Path(cache_dir).joinpath(f"{Path(source).stem}_p{per}_{key[-1]}_{digest}.nc")
+        
+        if cache_fp is not None and cache_fp.exists():
+            with xr.open_dataarray(cache_fp) as cached:
+                per_da = cached.load()
+        else:
+            per_da = doy_percentile(hist_da, per, window, alpha, beta).load()
+            if cache_fp is not None:
+                # write and rename so that concurrent processes never read a partially written file
+                tmp_fp = cache_fp.with_suffix(f".{os.getpid()}.tmp")
+                per_da.to_netcdf(tmp_fp)
+                os.replace(tmp_fp, cache_fp)
+        _hist_per_cache[key] = per_da
+        if len(_hist_per_cache) > _HIST_PER_CACHE_SIZE:
+            _hist_per_cache.popitem(last=False)
+    
+    return _hist_per_cache[key]
 
 
-def wsdi(tasmax, hist_da):
+def spell_threshold(hist_da, per, cache_dir, per_da):
+    """Helper function to get the day-of-year percentile thresholds for the spell duration indices, either as
+    supplied by the caller, or derived from historical data with hist_percentile.
+    
+    Args:
+        hist_da (xarray.DataArray): historical daily temperature values, not needed if per_da is supplied
+        per (int): percentile to derive from hist_da
+        cache_dir (path-like): directory for saving the historical percentiles, see hist_percentile
+        per_da (xarray.DataArray): precomputed day-of-year percentile thresholds
+        
+    Returns:
+        DataArray of percentile values for each day of the year, in memory or persisted
+    """
+    if per_da is None:
+        if hist_da is None:
+            raise ValueError("Either historical data or precomputed percentile thresholds need to be supplied")
+        per_da = hist_percentile(hist_da, per, cache_dir)
+    
+    if per_da.chunks is not None:
+        # materialize the thresholds once, so they are not recomputed for every block they are compared with
+        per_da = per_da.persist()
+    
+    return per_da
+
+
+@register("wsdi", needs_hist=True)
+def wsdi(tasmax, hist_da=None, cache_dir=None, tasmax_per=None):
     """'Warm spell duration index' - Annual count of occurrences of at least 5 consecutive days with daily max T above 90th percentile of historical values for the date
     
     Args:
         tasmax (xarray.DataArray): daily maximum temperature values
-        hist_da (xarray.DataArray): historical daily maximum temperature values
+        hist_da (xarray.DataArray): historical daily maximum temperature values, not needed if tasmax_per is supplied
+        cache_dir (path-like): directory for saving the historical percentiles, see hist_percentile
+        tasmax_per (xarray.DataArray): precomputed 90th percentile of historical values for each day of the year
         
     Returns:
-        Warm spell duration index for each year
+        Warm spell duration index for each year, as integers
     """
-    tasmax_per = percentile_doy(hist_da, per=90).sel(percentiles=90)
-    return xci.warm_spell_duration_index(tasmax, tasmax_per, window=6, freq="YS").drop("percentiles")
+    tasmax_per = spell_threshold(hist_da, 90, cache_dir, tasmax_per)
+    return annual_spell_days(tasmax, tasmax_per, above=True, window=6)
 
 
-def csdi(tasmin, hist_da):
+@register("csdi", needs_hist=True)
+def csdi(tasmin, hist_da=None, cache_dir=None, tasmin_per=None):
     """'Cold spell duration index' - Annual count of occurrences of at least 5 consecutive days with daily min T below 10th percentile of historical values for the date
     
     Args:
         tasmin (xarray.DataArray): daily minimum temperature values for a year
-        hist_da (xarray.DataArray): historical daily minimum temperature values
+        hist_da (xarray.DataArray): historical daily minimum temperature values, not needed if tasmin_per is supplied
+        cache_dir (path-like): directory for saving the historical percentiles, see hist_percentile
+        tasmin_per (xarray.DataArray): precomputed 10th percentile of historical values for each day of the year
         
     Returns:
-        Cold spell duration index for each year
+        Cold spell duration index for each year, as integers
     """
-    tasmin_per = percentile_doy(hist_da, per=10).sel(percentiles=10)
-    return xci.cold_spell_duration_index(tasmin, tasmin_per, window=6, freq="YS").drop("percentiles")
+    tasmin_per = spell_threshold(hist_da, 10, cache_dir, tasmin_per)
+    return annual_spell_days(tasmin, tasmin_per, above=False, window=6)
 
 
+@register("r10mm")
 def r10mm(pr):
     """'Heavy precip days' - number of days in a year with over 10mm of precip
     
@@ -179,13 +903,10 @@ def r10mm(pr):
     Returns:
         Number of heavy precip days for each year
     """
-    # code based on xclim.indices._threshold.tg_days_above
-    thresh = "10 mm/day"
-    thresh = convert_units_to(thresh, pr)
-    f = threshold_count(pr, ">", thresh, freq="YS")
-    return to_agg_units(f, pr, "count")
+    return annual_count(pr, "10 mm/day", above=True)
 
 
+@register("cwd")
 def cwd(pr):
     """'Consecutive wet days' - number of the most consecutive days with precip > 1 mm
     
@@ -193,11 +914,12 @@ def cwd(pr):
         pr (xarray.DataArray): daily total precip values
         
     Returns:
-        Max number of consecutive wet days for each year
+        Max number of consecutive wet days for each year, as integers
     """
-    return xci.maximum_consecutive_wet_days(pr, thresh=f"1 mm/day", freq="YS")
+    return annual_longest_run(pr, "1 mm/day", above=True)
 
 
+@register("cdd")
 def cdd(pr):
     """'Consecutive dry days' - number of the most consecutive days with precip < 1 mm
     
@@ -205,11 +927,12 @@ def cdd(pr):
         pr (xarray.DataArray): daily total precip values
         
     Returns:
-        Max number of consecutive dry days for each year
+        Max number of consecutive dry days for each year, as integers
     """
-    return xci.maximum_consecutive_dry_days(pr, thresh=f"1 mm/day", freq="YS")
+    return annual_longest_run(pr, "1 mm/day", above=False)
 
 
+@register("wndd")
 def wndd(sfcWind):
     """'Windy days' - number of days with mean wind speed > 10 m/s
     
@@ -219,11 +942,7 @@ def wndd(sfcWind):
     Returns:
         Max number of consecutive windy days for each year
     """
-    # code based on xclim.indices._threshold.tg_days_above
-    thresh = "10 m s-1"
-    thresh = convert_units_to(thresh, sfcWind)
-    f = threshold_count(sfcWind, ">", thresh, freq="YS")
-    return to_agg_units(f, sfcWind, "count")
+    return annual_count(sfcWind, "10 m s-1", above=True)
 
 
 def compute_index(da, index, model, scenario, kwargs={}):
@@ -231,42 +950,45 @@ def compute_index(da, index, model, scenario, kwargs={}):
     
     Args:
         da (xarray.DataArray): the DataArray object containing the base variable data to b summarized according to aggr
-        index (str): String corresponding to the name of the index to compute (assumes value is equal to the name of the corresponding function)
+        index (str): String corresponding to the name of the index to compute, as registered in INDEX_FUNCS
         scenario (str): scenario being run (for new coordinate dimension)
         model (str): model being run (for new coordinate dimension)
         kwargs (dict): additional arguments for the index function being called
             
     Returns:
-        A new data array with dimensions year, latitude, longitude, in that order containing the summarized information
+        A new data array with dimensions year, latitude, longitude, in that order containing the summarized information.
+        Cells without data are filled with nan, or with -9999 for indices returned as integers, such as the day counts
+        and the run-length indices cwd, cdd, wsdi and csdi
     """
-    new_da = (
-        globals()[index](da, **kwargs)
-        .transpose("time", "lat", "lon")
-        .reset_coords(["longitude", "latitude", "height"], drop=True)
-    )
-    new_da.name = index  
-    # get the nodata mask from first time slice
-    nodata = np.broadcast_to(
-        np.isnan(da.sel(time=da["time"].values[0]).transpose("lat", "lon")), 
-        new_da.shape
-    )
+    # every index reduces along time, so make sure each spatial block has the full time series
+    da = rechunk_time(da)
+    if da.dtype == np.float64:
+        # single precision is plenty for these data, and halves the memory traffic of the kernels
+        da = da.astype(np.float32)
+    out = INDEX_FUNCS[index](da, **kwargs).transpose("time", "lat", "lon")
+    # get the data mask from first time slice, kept lazy for dask-backed data
+    valid = da.isel(time=0, drop=True).reset_coords(drop=True).notnull().transpose("lat", "lon")
     # remask, because xclim switches nans to 0
     # xclim is inconsistent about the types returned.
-    if new_da.dtype in [np.int32, np.int64]:
-        new_da.values[nodata] = -9999
-    else:
-        new_da.values[nodata] = np.nan
-    
-    # add model and scenario coordinate dimensions to the data array
-    coords_di = {
-        "model": model,
-        "scenario": scenario,
-    }
-
-    new_dims = list(coords_di.keys())
-    new_da = new_da.assign_coords(coords_di).expand_dims(new_dims)
-    # convert the time dimension to integer years instead of CF time objects
-    years = [cftime.year for cftime in new_da.time.values]
-    new_da = new_da.rename({"time": "year"}).assign_coords({"year": years})
+    fill = -9999 if out.dtype.kind == "i" else np.nan
+    
+    # build the new data array in one go, with model and scenario coordinate dimensions, and
+    #  the time dimension converted to integer years instead of CF time objects.
+    #  Any other coordinates carried along by the index function are dropped here.
+    new_da = xr.DataArray(
+        out.data[np.newaxis, np.newaxis],
+        dims=("model", "scenario", "year", "lat", "lon"),
+        coords={
+            "model": [model],
+            "scenario": [scenario],
+            "year": np.asarray(out.get_index("time").year),
+            "lat": out["lat"].variable,
+            "lon": out["lon"].variable,
+        },
+        name=index,
+        attrs=out.attrs,
+    )
+    # the 2D mask is broadcast over all other dimensions by where, no full-size mask needed
+    new_da = new_da.where(valid, fill)
     
     return new_da